@@ -16,22 +16,53 @@
 # limitations under the License.
 
 
+from __future__ import annotations
+
 import json
 import logging
 import os
-import sys
 from pathlib import Path
-import torch
-from src.config import RunConfig, ModelConfigurations, model_tokenizer_mapping
-from src.evaluation import evaluate, predict
-from src.logging import initialize_log_dict
-from src.preprocessing import load_examples
-from src.training import train
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+
+def load_model_to_device(model_class, name_or_path, device: torch.device) -> torch.nn.Module:
+    """Load a pretrained model and move it to the device, staging the weights
+    in pinned memory so the host-to-device copies run asynchronously."""
+    model = model_class.from_pretrained(str(name_or_path))
+    if device.type == "cuda":
+        for parameter in model.parameters():
+            parameter.data = parameter.data.pin_memory()
+        model = model.to(device, non_blocking=True)
+        torch.cuda.synchronize()
+    else:
+        model = model.to(device)
+    return model
+
+
+def trace_model_for_inference(model: torch.nn.Module,
+                              model_type: str,
+                              run_config: RunConfig,
+                              device: torch.device) -> torch.jit.ScriptModule:
+    """Trace and freeze the model so inference skips Python dispatch and
+    benefits from constant folding and operator fusion."""
+    model.eval()
+    dummy = torch.zeros(1, run_config.max_seq_length, dtype=torch.long, device=device)
+    if model_type in ["xlm", "roberta", "distilbert", "camembert"]:
+        example_inputs = (dummy, dummy)
+    else:
+        example_inputs = (dummy, dummy, dummy)
+    traced = torch.jit.trace(model, example_inputs, strict=False)
+    traced = torch.jit.freeze(traced)
+    traced = torch.jit.optimize_for_inference(traced)
+    return traced
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
@@ -62,22 +93,58 @@ if __name__ == '__main__':
     assert args.train or args.eval or args.test, \
         "At least one task needs to be selected by passing --train, --eval or --test"
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # Heavy imports are deferred until the arguments are validated, so --help
+    # and typo'd invocations exit without paying CUDA initialization cost
+    os.environ.setdefault("CUDA_MODULE_LOADING", "LAZY")
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
+    import torch
+    import torch.distributed as dist
+    from src.config import RunConfig, ModelConfigurations, model_tokenizer_mapping
+    from src.evaluation import evaluate, predict
+    from src.logging import initialize_log_dict
+    from src.preprocessing import load_examples
+    from src.training import train
+
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+
+    # Distributed setup: one process per GPU when launched through torchrun,
+    # single process (CUDA or CPU) otherwise.
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    is_distributed = world_size > 1
+    if is_distributed:
+        if torch.cuda.is_available():
+            dist.init_process_group(backend="nccl")
+            torch.cuda.set_device(local_rank)
+            device = torch.device("cuda", local_rank)
+        else:
+            # Multi-process CPU launch: gloo backend, no device binding
+            dist.init_process_group(backend="gloo")
+            device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    is_main_process = not is_distributed or dist.get_rank() == 0
+
+    # Allow TF32 tensor cores for FP32 matmuls and let cuDNN autotune its
+    # algorithms (sequences are padded to a fixed length, so the tuned
+    # algorithm is reused on every batch)
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
 
     model_config = ModelConfigurations.RoBERTaSquadLarge
-    run_config = RunConfig()
-    run_config.do_train = args.train
-    run_config.do_eval = args.eval
-    run_config.do_test = args.test
+    run_config = RunConfig(do_train=args.train, do_eval=args.eval, do_test=args.test)
 
     RUN_NAME = 'model_run'
 
     (MODEL_TYPE, MODEL_NAME_OR_PATH, DO_LOWER_CASE) = model_config.value
 
-    fincausal_data_path = Path(os.environ.get('FINCAUSAL_DATA_PATH',
-                                              os.path.dirname(os.path.realpath(sys.argv[0])) + './data'))
-    fincausal_output_path = Path(os.environ.get('FINCAUSAL_OUTPUT_PATH',
-                                                os.path.dirname(os.path.realpath(sys.argv[0])) + './output'))
+    fincausal_data_path = Path(os.environ.get('FINCAUSAL_DATA_PATH', SCRIPT_DIR / 'data'))
+    fincausal_output_path = Path(os.environ.get('FINCAUSAL_OUTPUT_PATH', SCRIPT_DIR / 'output'))
 
     TRAIN_FILE = fincausal_data_path / "fnp2020-train.csv"
     EVAL_FILE = fincausal_data_path / "fnp2020-eval.csv"
@@ -87,24 +154,68 @@ if __name__ == '__main__':
         OUTPUT_DIR = fincausal_output_path / (MODEL_NAME_OR_PATH + '_' + RUN_NAME)
     else:
         OUTPUT_DIR = fincausal_output_path / MODEL_NAME_OR_PATH
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Shared cache so new RUN_NAMEs do not redownload the checkpoint from the hub
+    HF_CACHE_DIR = os.environ.get('HF_HOME', str(Path.home() / '.cache/huggingface'))
 
     model_class, tokenizer_class = model_tokenizer_mapping[MODEL_TYPE]
     log_file = initialize_log_dict(model_config=model_config,
                                    run_config=run_config,
                                    model_tokenizer_mapping=model_tokenizer_mapping)
 
+    # Model and tokenizer are shared across the train/eval/test branches so a
+    # combined --train --eval --test run loads the weights only once.
+    tokenizer = None
+    model = None
+
     # Training
     if run_config.do_train:
 
         tokenizer = tokenizer_class.from_pretrained(MODEL_NAME_OR_PATH,
                                                     do_lower_case=DO_LOWER_CASE,
-                                                    cache_dir=OUTPUT_DIR)
-        model = model_class.from_pretrained(MODEL_NAME_OR_PATH).to(device)
+                                                    cache_dir=HF_CACHE_DIR)
+        eval_prefetch = None
+        if run_config.do_eval and is_main_process:
+            # Warm the preprocessed-feature cache for the eval file in the
+            # background while the model loads and the train file is tokenized.
+            # The future is awaited below, before train() starts, so no eval
+            # can race it and the thread never overlaps any collectives.
+            prefetch_executor = ThreadPoolExecutor(max_workers=1)
+            eval_prefetch = prefetch_executor.submit(load_examples,
+                                                     file_path=EVAL_FILE,
+                                                     tokenizer=tokenizer,
+                                                     output_examples=True,
+                                                     evaluate=True,
+                                                     run_config=run_config)
+        model = load_model_to_device(model_class, MODEL_NAME_OR_PATH, device)
+        if is_distributed:
+            model = torch.nn.parallel.DistributedDataParallel(model,
+                                                              device_ids=[local_rank],
+                                                              gradient_as_bucket_view=True)
+        if run_config.torch_compile:
+            # Dynamo inserts graph breaks at DDP bucket boundaries so compiled
+            # backward still overlaps with gradient all-reduce
+            torch._dynamo.config.optimize_ddp = True
+            logger.info("Compiling model; the first training step will be slow")
+            model = torch.compile(model, backend="inductor", mode="max-autotune", dynamic=False)
+        scaler = torch.cuda.amp.GradScaler(enabled=run_config.fp16
+                                           and torch.cuda.is_available()
+                                           and run_config.amp_dtype is torch.float16)
 
+        # Every rank reaches this call, so rank 0 may build the cache while
+        # the others wait for it inside load_examples
         train_dataset = load_examples(file_path=TRAIN_FILE,
                                       tokenizer=tokenizer,
                                       output_examples=False,
-                                      run_config=run_config)
+                                      run_config=run_config,
+                                      synchronize=True)
+
+        if eval_prefetch is not None:
+            # Make sure the eval cache is fully written before the first
+            # in-training evaluation goes looking for it
+            eval_prefetch.result()
+            prefetch_executor.shutdown()
 
         train(train_dataset=train_dataset,
               model=model,
@@ -114,45 +225,73 @@ if __name__ == '__main__':
               predict_file=EVAL_FILE,
               device=device,
               log_file=log_file,
-              run_config=run_config
+              run_config=run_config,
+              scaler=scaler
               )
-        if not OUTPUT_DIR.is_dir():
-            OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-        if run_config.save_model:
-            model_to_save = model.module if hasattr(model, "module") else model
-            model_to_save.save_pretrained(OUTPUT_DIR)
-            tokenizer.save_pretrained(OUTPUT_DIR)
-            logger.info("Saving final model to %s", OUTPUT_DIR)
-        logger.info("Saving log file to %s", OUTPUT_DIR)
-        with open(os.path.join(OUTPUT_DIR, "logs.json"), 'w') as f:
-            json.dump(log_file, f, indent=4)
-
-    if run_config.do_eval:
-        tokenizer = tokenizer_class.from_pretrained(str(OUTPUT_DIR), do_lower_case=DO_LOWER_CASE)
-        model = model_class.from_pretrained(str(OUTPUT_DIR)).to(device)
-
-        result = evaluate(model=model,
-                          tokenizer=tokenizer,
-                          device=device,
-                          file_path=EVAL_FILE,
-                          model_type=MODEL_TYPE,
-                          output_dir=OUTPUT_DIR,
-                          run_config=run_config
-                          )
+        if is_main_process:
+            if run_config.save_model:
+                model_to_save = model.module if hasattr(model, "module") else model
+                model_to_save.save_pretrained(OUTPUT_DIR)
+                tokenizer.save_pretrained(OUTPUT_DIR)
+                logger.info("Saving final model to %s", OUTPUT_DIR)
+            logger.info("Saving log file to %s", OUTPUT_DIR)
+            if orjson is not None:
+                (OUTPUT_DIR / "logs.json").write_bytes(
+                    orjson.dumps(log_file,
+                                 option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+            else:
+                with open(OUTPUT_DIR / "logs.json", 'w') as f:
+                    json.dump(log_file, f, indent=4)
+        # Keep the trained weights in memory so eval/test reuse them directly
+        model = model.module if hasattr(model, "module") else model
+        model.eval()
+
+    if is_distributed and (run_config.do_eval or run_config.do_test):
+        # Make sure the final checkpoint is fully written before any rank reads it back.
+        dist.barrier()
+
+    if run_config.do_eval and is_main_process:
+        if model is None:
+            tokenizer = tokenizer_class.from_pretrained(str(OUTPUT_DIR), do_lower_case=DO_LOWER_CASE)
+            model = load_model_to_device(model_class, OUTPUT_DIR, device)
+        if run_config.jit_inference and not isinstance(model, torch.jit.ScriptModule):
+            model = trace_model_for_inference(model, MODEL_TYPE, run_config, device)
+
+        # optimized_execution(False) keeps the TorchScript profiling executor
+        # from re-specializing the graph whenever the batch shape changes,
+        # which otherwise causes multi-second stalls on the ragged last batch
+        with torch.jit.optimized_execution(False), torch.inference_mode():
+            result = evaluate(model=model,
+                              tokenizer=tokenizer,
+                              device=device,
+                              file_path=EVAL_FILE,
+                              model_type=MODEL_TYPE,
+                              output_dir=OUTPUT_DIR,
+                              run_config=run_config
+                              )
 
         print("done")
 
-    if run_config.do_test:
-        tokenizer = tokenizer_class.from_pretrained(str(OUTPUT_DIR), do_lower_case=DO_LOWER_CASE)
-        model = model_class.from_pretrained(str(OUTPUT_DIR)).to(device)
+    if run_config.do_test and is_main_process:
+        if model is None:
+            tokenizer = tokenizer_class.from_pretrained(str(OUTPUT_DIR), do_lower_case=DO_LOWER_CASE)
+            model = load_model_to_device(model_class, OUTPUT_DIR, device)
+        if run_config.jit_inference and not isinstance(model, torch.jit.ScriptModule):
+            model = trace_model_for_inference(model, MODEL_TYPE, run_config, device)
 
-        result = predict(model=model,
-                         tokenizer=tokenizer,
-                         device=device,
-                         file_path=TEST_FILE,
-                         model_type=MODEL_TYPE,
-                         output_dir=OUTPUT_DIR,
-                         run_config=run_config
-                         )
+        with torch.jit.optimized_execution(False), torch.inference_mode():
+            result = predict(model=model,
+                             tokenizer=tokenizer,
+                             device=device,
+                             file_path=TEST_FILE,
+                             model_type=MODEL_TYPE,
+                             output_dir=OUTPUT_DIR,
+                             run_config=run_config
+                             )
 
         print("done")
+
+    if is_distributed:
+        # Orderly teardown so NCCL does not flag an abnormal exit while
+        # rank 0 finishes the evaluation the other ranks skip
+        dist.destroy_process_group()
@@ -146,12 +146,20 @@ class FinCausalFeatures:
 
 class FinCausalResult:
     def __init__(self, unique_id, start_cause_logits, end_cause_logits, start_effect_logits, end_effect_logits,
-                 start_top_index=None, end_top_index=None, cls_logits=None):
+                 start_top_index=None, end_top_index=None, cls_logits=None,
+                 start_cause_top_indexes=None, end_cause_top_indexes=None,
+                 start_effect_top_indexes=None, end_effect_top_indexes=None):
         self.start_cause_logits = start_cause_logits
         self.end_cause_logits = end_cause_logits
         self.start_effect_logits = start_effect_logits
         self.end_effect_logits = end_effect_logits
         self.unique_id = unique_id
+        # Best candidate indexes per logit head, precomputed on the device
+        # during prediction; None when the consumer should rank them itself
+        self.start_cause_top_indexes = start_cause_top_indexes
+        self.end_cause_top_indexes = end_cause_top_indexes
+        self.start_effect_top_indexes = start_effect_top_indexes
+        self.end_effect_top_indexes = end_effect_top_indexes
 
         if start_top_index:
             self.start_top_index = start_top_index
@@ -20,15 +20,27 @@ import csv
 import json
 import logging
 import math
+import os
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from torch.nn import Module
 from torch.utils.data import SequentialSampler, DataLoader
 from tqdm import tqdm
 from transformers import PreTrainedTokenizer, PreTrainedTokenizerFast
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 from .config import RunConfig
 from .fincausal_evaluation.task2_evaluate import encode_causal_tokens, Task2Data
 from .data import FinCausalResult, FinCausalFeatures, FinCausalExample
@@ -38,8 +50,17 @@ from .fincausal_evaluation.task2_evaluate import evaluate as official_evaluate
 logger = logging.getLogger(__name__)
 
 
-def to_list(tensor: torch.Tensor) -> List:
-    return tensor.detach().cpu().tolist()
+# torch.compile is expensive on the first call, keep compiled models across
+# the repeated in-training evaluate() invocations
+_compiled_models: Dict[int, Module] = {}
+
+
+def _compile_for_inference(model: Module) -> Module:
+    compiled = _compiled_models.get(id(model))
+    if compiled is None:
+        compiled = torch.compile(model, mode="max-autotune")
+        _compiled_models[id(model)] = compiled
+    return compiled
 
 
 def predict(model: Module,
@@ -48,7 +69,8 @@ def predict(model: Module,
             file_path: Path,
             model_type: str,
             output_dir: Path,
-            run_config: RunConfig) -> Tuple[List[FinCausalExample], collections.OrderedDict]:
+            run_config: RunConfig,
+            batch_size: Optional[int] = None) -> Tuple[List[FinCausalExample], collections.OrderedDict]:
     dataset, examples, features = load_examples(file_path=file_path,
                                                 tokenizer=tokenizer,
                                                 output_examples=True,
@@ -58,24 +80,41 @@ def predict(model: Module,
     if not output_dir.is_dir():
         output_dir.mkdir(parents=True, exist_ok=True)
 
+    if batch_size is None:
+        batch_size = run_config.inference_batch_size
     eval_sampler = SequentialSampler(dataset)
+    # Background workers assemble and pin the host batches so the GPU never
+    # waits on host-side tensor collation
+    num_workers = max(2, min(8, (os.cpu_count() or 2) - 1))
     eval_dataloader = DataLoader(dataset,
                                  sampler=eval_sampler,
-                                 batch_size=run_config.eval_batch_size)
+                                 batch_size=batch_size,
+                                 num_workers=num_workers,
+                                 pin_memory=device.type == "cuda",
+                                 persistent_workers=True,
+                                 prefetch_factor=4)
 
     # Start evaluation
     logger.info("***** Running evaluation  *****")
     logger.info("  Num examples = %d", len(dataset))
-    logger.info("  Batch size = %d", run_config.eval_batch_size)
+    logger.info("  Batch size = %d", batch_size)
 
-    all_results = []
+    # One result per dataset row: preallocate instead of growing by append
+    all_results: List[Optional[FinCausalResult]] = [None] * len(dataset)
+    result_count = 0
     sequence_added_tokens = tokenizer.max_len - tokenizer.max_len_single_sentence
 
+    model.eval()
+    if run_config.torch_compile and device.type == "cuda" \
+            and not isinstance(model, torch.jit.ScriptModule):
+        model = _compile_for_inference(model)
     for batch in tqdm(eval_dataloader, desc="Evaluating", position=0, leave=True):
-        model.eval()
-        batch = tuple(t.to(device) for t in batch)
+        # The example indices stay on the host as plain ints; only the model
+        # inputs are shipped to the device
+        example_indices = batch[3].tolist()
+        batch = tuple(t.to(device, non_blocking=True) for t in batch[:3])
 
-        with torch.no_grad():
+        with torch.inference_mode():
             inputs = {
                 "input_ids": batch[0],
                 "attention_mask": batch[1],
@@ -85,20 +124,47 @@ def predict(model: Module,
             if model_type in ["xlm", "roberta", "distilbert", "camembert"]:
                 del inputs["token_type_ids"]
 
-            example_indices = batch[3]
-            outputs = model(**inputs)
+            with torch.autocast(device_type=device.type, dtype=run_config.amp_dtype,
+                                enabled=run_config.fp16 and device.type == "cuda"):
+                outputs = model(**inputs)
+
+            # Rank the candidate indexes for the whole batch on the device so
+            # the span filter does not re-rank each head per feature on CPU
+            top_k = min(run_config.n_best_size, outputs[0].shape[1])
+            device_tensors = list(outputs) + [torch.topk(logits, top_k, dim=1).indices
+                                              for logits in outputs]
+
+        if device.type == "cuda":
+            # Async device-to-host copies into pinned buffers per batch
+            # instead of a blocking transfer per example and logit tensor
+            cpu_outputs = []
+            for output in device_tensors:
+                buffer = torch.empty(output.shape, dtype=output.dtype, pin_memory=True)
+                buffer.copy_(output, non_blocking=True)
+                cpu_outputs.append(buffer)
+            torch.cuda.synchronize()
+        else:
+            cpu_outputs = device_tensors
 
         for i, example_index in enumerate(example_indices):
-            eval_feature = features[example_index.item()]
+            eval_feature = features[example_index]
             unique_id = int(eval_feature.unique_id)
 
-            output = [to_list(output[i]) for output in outputs]
+            # Keep logits as float32 arrays: no per-element boxing to Python
+            # floats, and the span filter can index/reduce them vectorized
+            output = [output[i].float().numpy() for output in cpu_outputs[:4]]
             start_cause_logits, end_cause_logits, start_effect_logits, end_effect_logits = output
+            top_indexes = [indexes[i].tolist() for indexes in cpu_outputs[4:]]
             result = FinCausalResult(unique_id,
                                      start_cause_logits, end_cause_logits,
-                                     start_effect_logits, end_effect_logits)
+                                     start_effect_logits, end_effect_logits,
+                                     start_cause_top_indexes=top_indexes[0],
+                                     end_cause_top_indexes=top_indexes[1],
+                                     start_effect_top_indexes=top_indexes[2],
+                                     end_effect_top_indexes=top_indexes[3])
 
-            all_results.append(result)
+            all_results[result_count] = result
+            result_count += 1
 
     # Compute predictions
     predictions = compute_predictions_logits(
@@ -119,25 +185,31 @@ def evaluate(model: Module,
              file_path: Path,
              model_type: str,
              output_dir: Path,
-             run_config: RunConfig) -> Dict:
+             run_config: RunConfig,
+             batch_size: Optional[int] = None) -> Dict:
     examples, predictions = predict(model=model,
                                     tokenizer=tokenizer,
                                     device=device,
                                     file_path=file_path,
                                     model_type=model_type,
                                     output_dir=output_dir,
-                                    run_config=run_config)
+                                    run_config=run_config,
+                                    batch_size=batch_size)
 
     # Compute the F1 and exact scores.
     results, correct, wrong = compute_metrics(examples, predictions)
     output_prediction_file_correct = output_dir / "predictions_correct.json"
     output_prediction_file_wrong = output_dir / "predictions_wrong.json"
 
-    with output_prediction_file_correct.open('w') as writer:
-        writer.write(json.dumps(correct, indent=4) + "\n")
+    if orjson is not None:
+        output_prediction_file_correct.write_bytes(orjson.dumps(correct, option=orjson.OPT_INDENT_2) + b"\n")
+        output_prediction_file_wrong.write_bytes(orjson.dumps(wrong, option=orjson.OPT_INDENT_2) + b"\n")
+    else:
+        with output_prediction_file_correct.open('w') as writer:
+            writer.write(json.dumps(correct, indent=4) + "\n")
 
-    with output_prediction_file_wrong.open('w') as writer:
-        writer.write(json.dumps(wrong, indent=4) + "\n")
+        with output_prediction_file_wrong.open('w') as writer:
+            writer.write(json.dumps(wrong, indent=4) + "\n")
 
     return results
 
@@ -166,37 +238,41 @@ def compute_metrics(examples: List[FinCausalExample], predictions: collections.O
         -> Tuple[Dict, List[Dict], List[Dict]]:
     y_true = []
     y_pred = []
-
+    all_correct = []
+    all_wrong = []
+
+    # Single pass over the examples: one prediction lookup per example, with
+    # the append methods bound to locals to skip the repeated attribute lookups
+    append_true = y_true.append
+    append_pred = y_pred.append
+    append_correct = all_correct.append
+    append_wrong = all_wrong.append
     for example in examples:
-        y_true.append([example.example_id, example.context_text, example.cause_text, example.effect_text])
         prediction = predictions[example.example_id]
-        y_pred.append([example.example_id, example.context_text, prediction['cause_text'], prediction['effect_text']])
-
-    all_correct = list()
-    all_wrong = list()
-    for y_true_ex, y_pred_ex in zip(y_true, y_pred):
-        if (y_true_ex[2] == y_pred_ex[2]) and (y_true_ex[3] == y_pred_ex[3]):
-            all_correct.append({'text': y_true_ex[1],
-                                'cause_true': y_true_ex[2],
-                                'effect_true': y_true_ex[3],
-                                'cause_pred': y_pred_ex[2],
-                                'effect_pred': y_pred_ex[3]
-                                })
+        cause_pred = prediction['cause_text']
+        effect_pred = prediction['effect_text']
+        append_true([example.example_id, example.context_text, example.cause_text, example.effect_text])
+        append_pred([example.example_id, example.context_text, cause_pred, effect_pred])
+        entry = {'text': example.context_text,
+                 'cause_true': example.cause_text,
+                 'effect_true': example.effect_text,
+                 'cause_pred': cause_pred,
+                 'effect_pred': effect_pred
+                 }
+        if example.cause_text == cause_pred and example.effect_text == effect_pred:
+            append_correct(entry)
         else:
-            all_wrong.append({'text': y_true_ex[1],
-                              'cause_true': y_true_ex[2],
-                              'effect_true': y_true_ex[3],
-                              'cause_pred': y_pred_ex[2],
-                              'effect_pred': y_pred_ex[3]
-                              })
+            append_wrong(entry)
     logging.info('* Loading reference data')
     y_true = get_data_from_list(y_true)
     logging.info('* Loading prediction data')
     y_pred = get_data_from_list(y_pred)
-    logging.info(f'Load Data: check data set length = {len(y_true) == len(y_pred)}')
-    logging.info(f'Load Data: check data set ref. text = {all([x.text == y.text for x, y in zip(y_true, y_pred)])}')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'Load Data: check data set length = {len(y_true) == len(y_pred)}')
+        logger.debug(f'Load Data: check data set ref. text = {all(x.text == y.text for x, y in zip(y_true, y_pred))}')
+    # The asserts (and their O(N) text comparison) are skipped under python -O
     assert len(y_true) == len(y_pred)
-    assert all([x.text == y.text for x, y in zip(y_true, y_pred)])
+    assert all(x.text == y.text for x, y in zip(y_true, y_pred))
 
     precision, recall, f1, exact_match = official_evaluate(y_true, y_pred, ['-', 'C', 'E'])
 
@@ -243,8 +319,177 @@ _NbestPrediction = collections.namedtuple(
 )
 
 
-def filter_impossible_spans(features,
-                            unique_id_to_result: Dict,
+def _feature_lookup_arrays(feature: FinCausalFeatures, seq_len: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Dense boolean views of token_to_orig_map membership and
+    token_is_max_context, so candidate checks index an array instead of
+    hashing into a dict."""
+    in_map = np.zeros(seq_len, dtype=bool)
+    in_map[list(feature.token_to_orig_map.keys())] = True
+    is_max_ctx = np.zeros(seq_len, dtype=bool)
+    for index, is_max in feature.token_is_max_context.items():
+        is_max_ctx[index] = is_max
+    return in_map, is_max_ctx
+
+
+def _filter_core(starts_cause: np.ndarray,
+                 ends_cause: np.ndarray,
+                 starts_effect: np.ndarray,
+                 ends_effect: np.ndarray,
+                 in_map: np.ndarray,
+                 is_max_ctx: np.ndarray,
+                 num_tokens: int,
+                 max_answer_length: int) -> np.ndarray:
+    """Purely numeric span-filter core: nested loops over the candidate
+    indices with early exits on the per-span constraints, returning the
+    surviving (start_cause, end_cause, start_effect, end_effect) rows.
+    Compiled with Numba when available."""
+    max_combinations = starts_cause.size * ends_cause.size * starts_effect.size * ends_effect.size
+    survivors = np.empty((max_combinations, 4), dtype=np.int64)
+    count = 0
+    for start_cause in starts_cause:
+        if start_cause >= num_tokens or not in_map[start_cause] or not is_max_ctx[start_cause]:
+            continue
+        for end_cause in ends_cause:
+            if end_cause < start_cause or end_cause >= num_tokens or not in_map[end_cause]:
+                continue
+            if end_cause - start_cause + 1 > max_answer_length:
+                continue
+            for start_effect in starts_effect:
+                if start_effect >= num_tokens or not in_map[start_effect] or not is_max_ctx[start_effect]:
+                    continue
+                # Cause and effect spans may not overlap
+                if start_cause <= start_effect <= end_cause:
+                    continue
+                for end_effect in ends_effect:
+                    if end_effect < start_effect or end_effect >= num_tokens or not in_map[end_effect]:
+                        continue
+                    if start_effect <= start_cause and end_effect >= start_cause:
+                        continue
+                    if end_effect - start_effect + 1 > max_answer_length:
+                        continue
+                    survivors[count, 0] = start_cause
+                    survivors[count, 1] = end_cause
+                    survivors[count, 2] = start_effect
+                    survivors[count, 3] = end_effect
+                    count += 1
+    return survivors[:count]
+
+
+if numba is not None:
+    _filter_core = numba.njit(cache=True)(_filter_core)
+
+
+def _filter_spans_vectorized(feature_index: int,
+                             feature: FinCausalFeatures,
+                             result: FinCausalResult,
+                             start_indexes_cause: List[int],
+                             end_indexes_cause: List[int],
+                             start_indexes_effect: List[int],
+                             end_indexes_effect: List[int],
+                             max_answer_length: int) -> List[_PrelimPrediction]:
+    """Evaluate all validity constraints over the candidate index grid in the
+    compiled _filter_core kernel (or as boolean masks over a meshgrid when
+    Numba is not installed) instead of a quadruple-nested Python loop. Only
+    usable when no sentence heuristic can rewrite the spans."""
+    num_tokens = len(feature.tokens)
+    in_map, is_max_ctx = _feature_lookup_arrays(feature, len(result.start_cause_logits))
+
+    if numba is not None:
+        survivors = _filter_core(np.asarray(start_indexes_cause, dtype=np.int64),
+                                 np.asarray(end_indexes_cause, dtype=np.int64),
+                                 np.asarray(start_indexes_effect, dtype=np.int64),
+                                 np.asarray(end_indexes_effect, dtype=np.int64),
+                                 in_map, is_max_ctx, num_tokens, max_answer_length)
+    else:
+        start_cause, end_cause, start_effect, end_effect = np.meshgrid(
+            np.asarray(start_indexes_cause), np.asarray(end_indexes_cause),
+            np.asarray(start_indexes_effect), np.asarray(end_indexes_effect),
+            indexing='ij')
+
+        valid = (end_cause >= start_cause) & (end_effect >= start_effect)
+        # Cause and effect spans may not overlap
+        valid &= ~((start_cause <= start_effect) & (end_cause >= start_effect))
+        valid &= ~((start_effect <= start_cause) & (end_effect >= start_cause))
+        valid &= (start_cause < num_tokens) & (end_cause < num_tokens) \
+            & (start_effect < num_tokens) & (end_effect < num_tokens)
+        valid &= in_map[start_cause] & in_map[end_cause] & in_map[start_effect] & in_map[end_effect]
+        valid &= is_max_ctx[start_cause] & is_max_ctx[start_effect]
+        valid &= (end_cause - start_cause + 1 <= max_answer_length) \
+            & (end_effect - start_effect + 1 <= max_answer_length)
+        survivors = np.stack([start_cause[valid], end_cause[valid],
+                              start_effect[valid], end_effect[valid]], axis=1)
+
+    start_logits_cause = result.start_cause_logits
+    end_logits_cause = result.end_cause_logits
+    start_logits_effect = result.start_effect_logits
+    end_logits_effect = result.end_effect_logits
+    predictions = []
+    for index_cause_start, index_cause_end, index_effect_start, index_effect_end in survivors.tolist():
+        predictions.append(
+            _PrelimPrediction(
+                feature_index=feature_index,
+                start_index_cause=index_cause_start,
+                end_index_cause=index_cause_end,
+                start_logit_cause=float(start_logits_cause[index_cause_start]),
+                end_logit_cause=float(end_logits_cause[index_cause_end]),
+                start_index_effect=index_effect_start,
+                end_index_effect=index_effect_end,
+                start_logit_effect=float(start_logits_effect[index_effect_start]),
+                end_logit_effect=float(end_logits_effect[index_effect_end])
+            )
+        )
+    return predictions
+
+
+def _valid_span_pairs(start_indexes: List[int],
+                      end_indexes: List[int],
+                      sentence_offsets: List[int],
+                      num_tokens: int,
+                      in_map: np.ndarray,
+                      is_max_ctx: np.ndarray,
+                      max_answer_length: int) -> List[Tuple[int, int]]:
+    """Candidate (start, end) pairs passing all single-span constraints, with
+    spans crossing a sentence boundary split at the boundary. Filtering per
+    span up front keeps the joint cause/effect loop to the few survivors."""
+    pairs = []
+    if not sentence_offsets:
+        # No boundary splitting possible: run a tight specialized loop with
+        # the start-token constraints hoisted out of the inner loop, instead
+        # of building a single-element span_pairs list per combination
+        for start_index in start_indexes:
+            if start_index >= num_tokens or not in_map[start_index] or not is_max_ctx[start_index]:
+                continue
+            for end_index in end_indexes:
+                if end_index < start_index or end_index >= num_tokens or not in_map[end_index]:
+                    continue
+                if end_index - start_index + 1 > max_answer_length:
+                    continue
+                pairs.append((start_index, end_index))
+        return pairs
+
+    for raw_start_index in start_indexes:
+        for raw_end_index in end_indexes:
+            span_pairs = [(raw_start_index, raw_end_index)]
+            for sentence_offset in sentence_offsets:
+                if raw_start_index < sentence_offset < raw_end_index:
+                    span_pairs = [(raw_start_index, sentence_offset),
+                                  (sentence_offset + 1, raw_end_index)]
+            for start_index, end_index in span_pairs:
+                if end_index < start_index:
+                    continue
+                if start_index >= num_tokens or end_index >= num_tokens:
+                    continue
+                if not in_map[start_index] or not in_map[end_index]:
+                    continue
+                if not is_max_ctx[start_index]:
+                    continue
+                if end_index - start_index + 1 > max_answer_length:
+                    continue
+                pairs.append((start_index, end_index))
+    return pairs
+
+
+def filter_impossible_spans(features_and_results: List[Tuple[FinCausalFeatures, FinCausalResult]],
                             n_best_size: int,
                             max_answer_length: int,
                             sequence_added_tokens: int,
@@ -254,130 +499,137 @@ def filter_impossible_spans(features,
                             ) -> List[_PrelimPrediction]:
     prelim_predictions = []
 
-    for (feature_index, feature) in enumerate(features):
-        result = unique_id_to_result[feature.unique_id]
+    for (feature_index, (feature, result)) in enumerate(features_and_results):
         assert isinstance(feature, FinCausalFeatures)
         assert isinstance(result, FinCausalResult)
         sentence_offsets = [offset for offset in [feature.sentence_2_offset, feature.sentence_3_offset] if
                             offset is not None]
-        start_indexes_cause = _get_best_indexes(result.start_cause_logits, n_best_size)
-        end_indexes_cause = _get_best_indexes(result.end_cause_logits, n_best_size)
+        # Prefer the candidate rankings computed on the device during
+        # prediction; rank here only for results that do not carry them
+        if result.start_cause_top_indexes is not None:
+            start_indexes_cause = result.start_cause_top_indexes[:n_best_size]
+            end_indexes_cause = result.end_cause_top_indexes[:n_best_size]
+            start_indexes_effect = result.start_effect_top_indexes[:n_best_size]
+            end_indexes_effect = result.end_effect_top_indexes[:n_best_size]
+        else:
+            start_indexes_cause = _get_best_indexes(result.start_cause_logits, n_best_size)
+            end_indexes_cause = _get_best_indexes(result.end_cause_logits, n_best_size)
+            start_indexes_effect = _get_best_indexes(result.start_effect_logits, n_best_size)
+            end_indexes_effect = _get_best_indexes(result.end_effect_logits, n_best_size)
         start_logits_cause = result.start_cause_logits
         end_logits_cause = result.end_cause_logits
-        start_indexes_effect = _get_best_indexes(result.start_effect_logits, n_best_size)
-        end_indexes_effect = _get_best_indexes(result.end_effect_logits, n_best_size)
         start_logits_effect = result.start_effect_logits
         end_logits_effect = result.end_effect_logits
 
-        for raw_start_index_cause in start_indexes_cause:
-            for raw_end_index_cause in end_indexes_cause:
-                cause_pairs = [(raw_start_index_cause, raw_end_index_cause)]
-                # Heuristic: a effect of a cause cannot span across multiple sentences
-                if len(sentence_offsets) > 0 and sentence_boundary_heuristic:
-                    for sentence_offset in sentence_offsets:
-                        if raw_start_index_cause < sentence_offset < raw_end_index_cause:
-                            cause_pairs = [(raw_start_index_cause, sentence_offset),
-                                           (sentence_offset + 1, raw_end_index_cause)]
-                for start_index_cause, end_index_cause in cause_pairs:
-                    for raw_start_index_effect in start_indexes_effect:
-                        for raw_end_index_effect in end_indexes_effect:
-                            effect_pairs = [(raw_start_index_effect, raw_end_index_effect)]
-                            # Heuristic: a effect of a cause cannot span across multiple sentences
-                            if len(sentence_offsets) > 0 and sentence_boundary_heuristic:
-                                for sentence_offset in sentence_offsets:
-                                    if raw_start_index_effect < sentence_offset < raw_end_index_effect:
-                                        effect_pairs = [(raw_start_index_effect, sentence_offset),
-                                                        (sentence_offset + 1, raw_end_index_effect)]
-                            for start_index_effect, end_index_effect in effect_pairs:
-                                if (start_index_cause <= start_index_effect) and (
-                                        end_index_cause >= start_index_effect):
-                                    continue
-                                if (start_index_effect <= start_index_cause) and (
-                                        end_index_effect >= start_index_cause):
-                                    continue
-                                if start_index_effect >= len(feature.tokens) or start_index_cause >= len(
-                                        feature.tokens):
-                                    continue
-                                if end_index_effect >= len(feature.tokens) or end_index_cause >= len(feature.tokens):
-                                    continue
-                                if start_index_effect not in feature.token_to_orig_map or \
-                                        start_index_cause not in feature.token_to_orig_map:
-                                    continue
-                                if end_index_effect not in feature.token_to_orig_map or \
-                                        end_index_cause not in feature.token_to_orig_map:
-                                    continue
-                                if (not feature.token_is_max_context.get(start_index_effect, False)) or \
-                                        (not feature.token_is_max_context.get(start_index_cause, False)):
-                                    continue
-                                if end_index_cause < start_index_cause:
-                                    continue
-                                if end_index_effect < start_index_effect:
-                                    continue
-                                length_cause = end_index_cause - start_index_cause + 1
-                                length_effect = end_index_effect - start_index_effect + 1
-                                if length_cause > max_answer_length:
-                                    continue
-                                if length_effect > max_answer_length:
-                                    continue
-
-                                # Heuristics extending the prediction spans
-                                if full_sentence_heuristic or shared_sentence_heuristic:
-                                    num_tokens = len(feature.tokens)
-                                    all_sentence_offsets = [sequence_added_tokens] + \
-                                                           [offset + 1 for offset in sentence_offsets] + \
-                                                           [num_tokens]
-                                    cause_sentences = []
-                                    effect_sentences = []
-                                    for sentence_idx in range(len(all_sentence_offsets) - 1):
-                                        sentence_start, sentence_end = all_sentence_offsets[sentence_idx], \
-                                                                       all_sentence_offsets[sentence_idx + 1]
-                                        if sentence_start <= start_index_cause < sentence_end:
-                                            cause_sentences.append(sentence_idx)
-                                        if sentence_start <= start_index_effect < sentence_end:
-                                            effect_sentences.append(sentence_idx)
-
-                                    # Heuristic (first rule): if a sentence contains only 1 clause the clause is
-                                    # extended to the entire sentence.
-                                    if set(cause_sentences).isdisjoint(set(effect_sentences)) \
-                                            and full_sentence_heuristic:
-                                        start_index_cause = min(
-                                            [all_sentence_offsets[sent] for sent in cause_sentences])
-                                        end_index_cause = max(
-                                            [all_sentence_offsets[sent + 1] - 1 for sent in cause_sentences])
-                                        start_index_effect = min(
-                                            [all_sentence_offsets[sent] for sent in effect_sentences])
-                                        end_index_effect = max(
-                                            [all_sentence_offsets[sent + 1] - 1 for sent in effect_sentences])
-                                    # Heuristic (third rule): if a sentence contains only 2 clauses the span is
-                                    # extended as much as possible.
-                                    if not set(cause_sentences).isdisjoint(set(effect_sentences)) \
-                                            and shared_sentence_heuristic \
-                                            and len(cause_sentences) == 1 \
-                                            and len(effect_sentences) == 1:
-                                        if start_index_cause < start_index_effect:
-                                            start_index_cause = min(
-                                                [all_sentence_offsets[sent] for sent in cause_sentences])
-                                            end_index_effect = max(
-                                                [all_sentence_offsets[sent + 1] - 1 for sent in effect_sentences])
-                                        else:
-                                            start_index_effect = min(
-                                                [all_sentence_offsets[sent] for sent in effect_sentences])
-                                            end_index_cause = max(
-                                                [all_sentence_offsets[sent + 1] - 1 for sent in cause_sentences])
-
-                                prelim_predictions.append(
-                                    _PrelimPrediction(
-                                        feature_index=feature_index,
-                                        start_index_cause=start_index_cause,
-                                        end_index_cause=end_index_cause,
-                                        start_logit_cause=start_logits_cause[start_index_cause],
-                                        end_logit_cause=end_logits_cause[end_index_cause],
-                                        start_index_effect=start_index_effect,
-                                        end_index_effect=end_index_effect,
-                                        start_logit_effect=start_logits_effect[start_index_effect],
-                                        end_logit_effect=end_logits_effect[end_index_effect]
-                                    )
-                                )
+        # The heuristics can split or extend candidate spans; without them the
+        # constraints are pure per-index predicates and vectorize cleanly.
+        heuristics_active = (len(sentence_offsets) > 0
+                             and (sentence_boundary_heuristic or full_sentence_heuristic)) \
+            or shared_sentence_heuristic
+        if not heuristics_active:
+            prelim_predictions.extend(
+                _filter_spans_vectorized(feature_index, feature, result,
+                                         start_indexes_cause, end_indexes_cause,
+                                         start_indexes_effect, end_indexes_effect,
+                                         max_answer_length))
+            continue
+
+        # Heuristic: a effect of a cause cannot span across multiple sentences
+        split_offsets = sentence_offsets if sentence_boundary_heuristic else []
+        num_tokens = len(feature.tokens)
+        in_map, is_max_ctx = _feature_lookup_arrays(feature, len(result.start_cause_logits))
+        cause_pairs = _valid_span_pairs(start_indexes_cause, end_indexes_cause,
+                                        split_offsets, num_tokens, in_map, is_max_ctx,
+                                        max_answer_length)
+        effect_pairs = _valid_span_pairs(start_indexes_effect, end_indexes_effect,
+                                         split_offsets, num_tokens, in_map, is_max_ctx,
+                                         max_answer_length)
+
+        # Sentence boundaries and per-token sentence membership only depend on
+        # the feature; compute them once instead of per cause/effect combination
+        all_sentence_offsets = []
+        token_sentences = []
+        if full_sentence_heuristic or shared_sentence_heuristic:
+            all_sentence_offsets = [sequence_added_tokens] + \
+                                   [offset + 1 for offset in sentence_offsets] + \
+                                   [num_tokens]
+            token_sentences = [
+                [sentence_idx for sentence_idx in range(len(all_sentence_offsets) - 1)
+                 if all_sentence_offsets[sentence_idx] <= token_index < all_sentence_offsets[sentence_idx + 1]]
+                for token_index in range(num_tokens)]
+
+        # Only the overlap constraint and the extension heuristics depend on
+        # the cause and effect spans jointly. The extension heuristics can map
+        # several candidates onto the same spans, so duplicates are skipped at
+        # the source instead of hashing every namedtuple field afterwards.
+        seen_spans = set()
+        for cause_start_index, cause_end_index in cause_pairs:
+            for effect_start_index, effect_end_index in effect_pairs:
+                # The extension heuristics below reassign the span indexes, so
+                # every combination starts from fresh locals bound to the
+                # validated pair: an extended span from one iteration must not
+                # leak into the next one
+                start_index_cause, end_index_cause = cause_start_index, cause_end_index
+                start_index_effect, end_index_effect = effect_start_index, effect_end_index
+                if (start_index_cause <= start_index_effect) and (
+                        end_index_cause >= start_index_effect):
+                    continue
+                if (start_index_effect <= start_index_cause) and (
+                        end_index_effect >= start_index_cause):
+                    continue
+
+                # Heuristics extending the prediction spans
+                if full_sentence_heuristic or shared_sentence_heuristic:
+                    cause_sentences = token_sentences[start_index_cause]
+                    effect_sentences = token_sentences[start_index_effect]
+
+                    # Heuristic (first rule): if a sentence contains only 1 clause the clause is
+                    # extended to the entire sentence.
+                    if set(cause_sentences).isdisjoint(set(effect_sentences)) \
+                            and full_sentence_heuristic:
+                        start_index_cause = min(
+                            [all_sentence_offsets[sent] for sent in cause_sentences])
+                        end_index_cause = max(
+                            [all_sentence_offsets[sent + 1] - 1 for sent in cause_sentences])
+                        start_index_effect = min(
+                            [all_sentence_offsets[sent] for sent in effect_sentences])
+                        end_index_effect = max(
+                            [all_sentence_offsets[sent + 1] - 1 for sent in effect_sentences])
+                    # Heuristic (third rule): if a sentence contains only 2 clauses the span is
+                    # extended as much as possible.
+                    if not set(cause_sentences).isdisjoint(set(effect_sentences)) \
+                            and shared_sentence_heuristic \
+                            and len(cause_sentences) == 1 \
+                            and len(effect_sentences) == 1:
+                        if start_index_cause < start_index_effect:
+                            start_index_cause = min(
+                                [all_sentence_offsets[sent] for sent in cause_sentences])
+                            end_index_effect = max(
+                                [all_sentence_offsets[sent + 1] - 1 for sent in effect_sentences])
+                        else:
+                            start_index_effect = min(
+                                [all_sentence_offsets[sent] for sent in effect_sentences])
+                            end_index_cause = max(
+                                [all_sentence_offsets[sent + 1] - 1 for sent in cause_sentences])
+
+                span_key = (start_index_cause, end_index_cause, start_index_effect, end_index_effect)
+                if span_key in seen_spans:
+                    continue
+                seen_spans.add(span_key)
+
+                prelim_predictions.append(
+                    _PrelimPrediction(
+                        feature_index=feature_index,
+                        start_index_cause=start_index_cause,
+                        end_index_cause=end_index_cause,
+                        start_logit_cause=float(start_logits_cause[start_index_cause]),
+                        end_logit_cause=float(end_logits_cause[end_index_cause]),
+                        start_index_effect=start_index_effect,
+                        end_index_effect=end_index_effect,
+                        start_logit_effect=float(start_logits_effect[start_index_effect]),
+                        end_logit_effect=float(end_logits_effect[end_index_effect])
+                    )
+                )
     return prelim_predictions
 
 
@@ -447,6 +699,15 @@ def compute_predictions_logits(
         output_dir: Path,
         sequence_added_tokens: int,
         run_config: RunConfig) -> collections.OrderedDict:
+    # Read the hyperparameters once so the per-example loop hits locals
+    # instead of attribute lookups
+    n_best_size = run_config.n_best_size
+    max_answer_length = run_config.max_answer_length
+    top_n_sentences = run_config.top_n_sentences
+    sentence_boundary_heuristic = run_config.sentence_boundary_heuristic
+    full_sentence_heuristic = run_config.full_sentence_heuristic
+    shared_sentence_heuristic = run_config.shared_sentence_heuristic
+
     example_index_to_features = collections.defaultdict(list)
     for feature in all_features:
         example_index_to_features[feature.example_index].append(feature)
@@ -458,147 +719,188 @@ def compute_predictions_logits(
     all_predictions = collections.OrderedDict()
     all_nbest_json = collections.OrderedDict()
 
-    for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
-        suffix_index = 0
-        if example.example_id.count('.') == 2 and run_config.top_n_sentences:
-            suffix_index = int(example.example_id.split('.')[-1])
-        prelim_predictions = filter_impossible_spans(features,
-                                                     unique_id_to_result,
-                                                     run_config.n_best_size,
-                                                     run_config.max_answer_length,
-                                                     sequence_added_tokens,
-                                                     run_config.sentence_boundary_heuristic,
-                                                     run_config.full_sentence_heuristic,
-                                                     run_config.shared_sentence_heuristic, )
-        prelim_predictions = sorted(list(set(prelim_predictions)),
-                                    key=lambda x: (x.start_logit_cause + x.end_logit_cause +
-                                                   x.start_logit_effect + x.end_logit_effect),
-                                    reverse=True)
-
-        nbest = get_predictions(prelim_predictions, run_config.n_best_size, features, example)
-
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a none prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(_NbestPrediction(text_cause="empty", start_logit_cause=0.0, end_logit_cause=0.0,
-                                          text_effect="empty", start_logit_effect=0.0, end_logit_effect=0.0,
-                                          start_index_effect=0, end_index_effect=0,
-                                          start_index_cause=0, end_index_cause=0))
-
-        assert len(nbest) >= 1
-
-        total_scores = []
-        best_non_null_entry = None
-        for entry in nbest:
-            total_scores.append(entry.start_logit_cause + entry.end_logit_cause +
-                                entry.start_logit_effect + entry.end_logit_effect)
-            if not best_non_null_entry:
-                if entry.text_cause and entry.text_effect:
-                    best_non_null_entry = entry
-
-        probabilities = _compute_softmax(total_scores)
-
-        nbest_json = []
-        current_example_spans = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = example.context_text
-            output["probability"] = probabilities[i]
-            output["cause_text"] = entry.text_cause
-            output["cause_start_index"] = entry.start_index_cause
-            output["cause_end_index"] = entry.end_index_cause
-            output["cause_start_score"] = entry.start_logit_cause
-            output["cause_end_score"] = entry.end_logit_cause
-            output["effect_text"] = entry.text_effect
-            output["effect_start_score"] = entry.start_logit_effect
-            output["effect_end_score"] = entry.end_logit_effect
-            output["effect_start_index"] = entry.start_index_effect
-            output["effect_end_index"] = entry.end_index_effect
-            new_span = SpanCombination(start_cause=entry.start_index_cause, end_cause=entry.end_index_cause,
-                                       start_effect=entry.start_index_effect, end_effect=entry.end_index_effect)
-            output["is_new"] = all([new_span != other for other in current_example_spans])
-            nbest_json.append(output)
-            current_example_spans.append(new_span)
-
-        assert len(nbest_json) >= 1
-        if suffix_index > 0:
-            suffix_index -= 1
-        all_predictions[example.example_id] = {"text": nbest_json[suffix_index]["text"],
-                                               "cause_text": nbest_json[suffix_index]["cause_text"],
-                                               "effect_text": nbest_json[suffix_index]["effect_text"]}
-        all_nbest_json[example.example_id] = nbest_json
+    # Each example's CSV row is known as soon as its best entry is chosen, so
+    # stream the rows out during the main loop instead of a second full pass
+    # over all_predictions afterwards
+    csv_output_prediction_file = output_dir / "predictions.csv"
+    with open(csv_output_prediction_file, "w", encoding='utf-8', newline='', buffering=1 << 20) as csv_file:
+        csv_writer = csv.writer(csv_file, delimiter=';')
+        csv_writer.writerow(['Index', 'Text', 'Cause', 'Effect'])
+
+        for (example_index, example) in enumerate(all_examples):
+            features = example_index_to_features[example_index]
+            suffix_index = 0
+            if example.example_id.count('.') == 2 and top_n_sentences:
+                suffix_index = int(example.example_id.split('.')[-1])
+            # Look up each feature's result once instead of hashing unique_ids
+            # again inside the span filter
+            features_and_results = [(feature, unique_id_to_result[feature.unique_id])
+                                    for feature in features]
+            prelim_predictions = filter_impossible_spans(features_and_results,
+                                                         n_best_size,
+                                                         max_answer_length,
+                                                         sequence_added_tokens,
+                                                         sentence_boundary_heuristic,
+                                                         full_sentence_heuristic,
+                                                         shared_sentence_heuristic, )
+            # Sort by total logit score in one vectorized pass instead of a
+            # Python-level key function; filter_impossible_spans already emits
+            # each span combination at most once per feature. The full ordering
+            # (not just the top n_best_size) is kept because get_predictions may
+            # skip candidates whose texts were already seen.
+            if prelim_predictions:
+                scores = np.fromiter((prediction.start_logit_cause + prediction.end_logit_cause +
+                                      prediction.start_logit_effect + prediction.end_logit_effect
+                                      for prediction in prelim_predictions),
+                                     dtype=np.float32, count=len(prelim_predictions))
+                order = np.argsort(-scores, kind='stable')
+                prelim_predictions = [prelim_predictions[index] for index in order]
+
+            nbest = get_predictions(prelim_predictions, n_best_size, features, example)
+
+            # In very rare edge cases we could have no valid predictions. So we
+            # just create a none prediction in this case to avoid failure.
+            if not nbest:
+                nbest.append(_NbestPrediction(text_cause="empty", start_logit_cause=0.0, end_logit_cause=0.0,
+                                              text_effect="empty", start_logit_effect=0.0, end_logit_effect=0.0,
+                                              start_index_effect=0, end_index_effect=0,
+                                              start_index_cause=0, end_index_cause=0))
+
+            assert len(nbest) >= 1
+
+            total_scores = []
+            best_non_null_entry = None
+            for entry in nbest:
+                total_scores.append(entry.start_logit_cause + entry.end_logit_cause +
+                                    entry.start_logit_effect + entry.end_logit_effect)
+                if not best_non_null_entry:
+                    if entry.text_cause and entry.text_effect:
+                        best_non_null_entry = entry
+
+            probabilities = _compute_softmax(total_scores)
+
+            # Score the entries first with lightweight tuples, then materialize
+            # the JSON dicts in one comprehension right before serialization
+            nbest_records = []
+            current_example_spans = []
+            for (i, entry) in enumerate(nbest):
+                new_span = SpanCombination(start_cause=entry.start_index_cause, end_cause=entry.end_index_cause,
+                                           start_effect=entry.start_index_effect, end_effect=entry.end_index_effect)
+                is_new = not any(_spans_overlap(new_span, other) for other in current_example_spans)
+                nbest_records.append((probabilities[i], entry, is_new))
+                current_example_spans.append(new_span)
+
+            context_text = example.context_text
+            nbest_json = [
+                {
+                    "text": context_text,
+                    "probability": probability,
+                    "cause_text": entry.text_cause,
+                    "cause_start_index": entry.start_index_cause,
+                    "cause_end_index": entry.end_index_cause,
+                    "cause_start_score": entry.start_logit_cause,
+                    "cause_end_score": entry.end_logit_cause,
+                    "effect_text": entry.text_effect,
+                    "effect_start_score": entry.start_logit_effect,
+                    "effect_end_score": entry.end_logit_effect,
+                    "effect_start_index": entry.start_index_effect,
+                    "effect_end_index": entry.end_index_effect,
+                    "is_new": is_new,
+                }
+                for probability, entry, is_new in nbest_records
+            ]
+
+            assert len(nbest_json) >= 1
+            if suffix_index > 0:
+                suffix_index -= 1
+            best_entry = nbest_json[suffix_index]
+            all_predictions[example.example_id] = {"text": best_entry["text"],
+                                                   "cause_text": best_entry["cause_text"],
+                                                   "effect_text": best_entry["effect_text"]}
+            csv_writer.writerow([example.example_id, best_entry["text"],
+                                 best_entry["cause_text"], best_entry["effect_text"]])
+            all_nbest_json[example.example_id] = nbest_json
 
     output_prediction_file = output_dir / "predictions.json"
-    csv_output_prediction_file = output_dir / "predictions.csv"
     output_nbest_file = output_dir / "nbest_predictions.json"
 
     logger.info("Writing predictions to: %s" % output_prediction_file)
-    with open(output_prediction_file, "w") as writer:
-        writer.write(json.dumps(all_predictions, indent=4) + "\n")
-
-    with open(csv_output_prediction_file, "w", encoding='utf-8', newline='') as writer:
-        csv_writer = csv.writer(writer, delimiter=';')
-        csv_writer.writerow(['Index', 'Text', 'Cause', 'Effect'])
-        for (example_id, prediction) in all_predictions.items():
-            csv_writer.writerow([example_id, prediction['text'], prediction['cause_text'], prediction['effect_text']])
-
+    if orjson is not None:
+        output_prediction_file.write_bytes(orjson.dumps(all_predictions, option=orjson.OPT_INDENT_2) + b"\n")
+    else:
+        with open(output_prediction_file, "w") as writer:
+            writer.write(json.dumps(all_predictions, indent=4) + "\n")
+
+    # The nbest file is by far the largest output; write it compact, nothing
+    # downstream parses it by line
     logger.info("Writing nbest to: %s" % output_nbest_file)
-    with open(output_nbest_file, "w") as writer:
-        writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
+    if orjson is not None:
+        output_nbest_file.write_bytes(orjson.dumps(all_nbest_json) + b"\n")
+    else:
+        with open(output_nbest_file, "w") as writer:
+            writer.write(json.dumps(all_nbest_json) + "\n")
 
     return all_predictions
 
 
-class SpanCombination:
-    def __init__(self, start_cause: int, end_cause: int, start_effect: int, end_effect: int):
-        self.start_cause = start_cause
-        self.start_effect = start_effect
-        self.end_cause = end_cause
-        self.end_effect = end_effect
+class SpanCombination(NamedTuple):
+    start_cause: int
+    end_cause: int
+    start_effect: int
+    end_effect: int
 
-    def __eq__(self, other):
-        overlapping_cause = (self.start_cause <= other.start_cause <= self.end_cause) or \
-                            (self.start_cause <= other.end_cause <= self.end_cause) or \
-                            (self.start_effect <= other.start_cause <= self.end_effect) or \
-                            (self.start_effect <= other.end_cause <= self.end_effect)
-        overlapping_effect = (self.start_effect <= other.start_effect <= self.end_effect) or \
-                             (self.start_effect <= other.end_effect <= self.end_effect) or \
-                             (self.start_cause <= other.start_effect <= self.end_cause) or \
-                             (self.start_cause <= other.end_effect <= self.end_cause)
-        return overlapping_cause and overlapping_effect
 
+def _spans_overlap(span: SpanCombination, other: SpanCombination) -> bool:
+    """Whether `other`'s cause and effect endpoints both fall inside `span`'s
+    cause or effect intervals (the criterion previously implemented as
+    SpanCombination.__eq__). Returns early when the cause half already fails."""
+    if not ((span.start_cause <= other.start_cause <= span.end_cause) or
+            (span.start_cause <= other.end_cause <= span.end_cause) or
+            (span.start_effect <= other.start_cause <= span.end_effect) or
+            (span.start_effect <= other.end_cause <= span.end_effect)):
+        return False
+    return (span.start_effect <= other.start_effect <= span.end_effect) or \
+           (span.start_effect <= other.end_effect <= span.end_effect) or \
+           (span.start_cause <= other.start_effect <= span.end_cause) or \
+           (span.start_cause <= other.end_effect <= span.end_cause)
 
-def _get_best_indexes(logits, n_best_size) -> List[int]:
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
 
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+def _get_best_indexes(logits, n_best_size) -> List[int]:
+    """Get the n-best logits from a list: O(N) argpartition for the top k,
+    then a sort of just those k (descending score, ties by original index)."""
+    scores = np.asarray(logits)
+    k = min(n_best_size, scores.size)
+    top_k = np.argpartition(-scores, k - 1)[:k]
+    # Ascending index order before the stable sort so ties keep the original
+    # lowest-index-first ordering of the previous sorted(enumerate(...)) code
+    top_k.sort()
+    return top_k[np.argsort(-scores[top_k], kind='stable')].tolist()
 
 
 def _compute_softmax(scores) -> List[float]:
-    """Compute softmax probability over raw logits."""
+    """Compute softmax probability over raw logits (max-subtracted for
+    numerical stability). Small inputs — the common case, nbest holds at
+    most n_best_size entries — use an online one-pass accumulation where
+    Python overhead beats the numpy call overhead; larger inputs fall
+    through to the vectorized numpy version."""
     if not scores:
         return []
 
-    max_score = None
-    for score in scores:
-        if max_score is None or score > max_score:
-            max_score = score
-
-    exp_scores = []
-    total_sum = 0.0
-    for score in scores:
-        x = math.exp(score - max_score)
-        exp_scores.append(x)
-        total_sum += x
-
-    probabilities = []
-    for score in exp_scores:
-        probabilities.append(score / total_sum)
-    return probabilities
+    if len(scores) <= 32:
+        exp = math.exp
+        running_max = float('-inf')
+        denominator = 0.0
+        for score in scores:
+            if score > running_max:
+                # Rescale the denominator accumulated under the previous max
+                denominator = denominator * exp(running_max - score) + 1.0
+                running_max = score
+            else:
+                denominator += exp(score - running_max)
+        return [exp(score - running_max) / denominator for score in scores]
+
+    probabilities = np.asarray(scores, dtype=np.float64)
+    probabilities -= probabilities.max()
+    np.exp(probabilities, out=probabilities)
+    probabilities /= probabilities.sum()
+    return probabilities.tolist()
@@ -52,15 +52,20 @@ import os
 import unittest
 
 from collections import namedtuple
+from functools import lru_cache
 
 import nltk
 
 from sklearn import metrics
 
 
+@lru_cache(maxsize=None)
 def build_token_index(text):
     """
     build a dictionary of all tokenized items from text with their respective positions in the text.
+    The result is memoized per text: the same reference text is encoded once for the ground truth
+    and once for the prediction, so caching halves the tokenization work. Callers only read the
+    returned tokens and index, so sharing them across calls is safe.
     E.g. "this is a basic example of a basic method" returns
      {'this': [0], 'is': [1], 'a': [2, 6], 'basic': [3, 7], 'example': [4], 'of': [5], 'method': [8]}
     :param text: reference text to index
@@ -14,8 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
 import multiprocessing
+import os
 from collections import UserDict
 from functools import partial
 from pathlib import Path
@@ -27,6 +29,7 @@ from pysbd.utils import PySBDFactory
 import numpy as np
 import pandas as pd
 import torch
+import torch.distributed as dist
 from torch.utils.data import TensorDataset
 from tqdm import tqdm
 from transformers import PreTrainedTokenizer, BatchEncoding, PreTrainedTokenizerFast
@@ -38,28 +41,62 @@ from .data import FinCausalExample, FinCausalFeatures, _is_punctuation
 logger = logging.getLogger(__name__)
 
 
+def _features_cache_path(file_path: Path,
+                         tokenizer: Union[PreTrainedTokenizer, PreTrainedTokenizerFast],
+                         run_config: RunConfig,
+                         evaluate: bool) -> Path:
+    key = hashlib.sha1(f"{file_path.stat().st_mtime_ns}|{type(tokenizer).__name__}|"
+                       f"{run_config.max_seq_length}|{run_config.doc_stride}|{evaluate}".encode()).hexdigest()
+    return file_path.parent / f"cached_{file_path.stem}_{key}.pt"
+
+
 def load_examples(file_path: Path,
                   tokenizer: Union[PreTrainedTokenizer, PreTrainedTokenizerFast],
                   run_config: RunConfig,
                   output_examples: bool = True,
-                  evaluate: bool = False) -> \
+                  evaluate: bool = False,
+                  synchronize: bool = False) -> \
         Union[Tuple[TensorDataset, List[FinCausalExample], List[FinCausalFeatures]],
               TensorDataset]:
-    processor = FinCausalProcessor()
-    examples = processor.get_examples(file_path)
-
-    features, dataset = fincausal_convert_examples_to_features(
-        examples=examples,
-        tokenizer=tokenizer,
-        max_seq_length=run_config.max_seq_length,
-        doc_stride=run_config.doc_stride,
-        is_training=not evaluate,
-        return_dataset="pt",
-        threads=1,
-    )
-
+    """Load (and cache) the preprocessed features for a data file.
+
+    `synchronize` may only be passed as True from call sites that every
+    distributed rank executes: it makes rank 0 build the cache while the other
+    ranks wait at a barrier and read the cached copy. Rank-0-only paths (the
+    in-training and post-training evaluations) must leave it False — a barrier
+    issued from a single rank would pair with an unrelated collective on the
+    other ranks and deadlock the run.
+    """
+    cache_path = _features_cache_path(file_path, tokenizer, run_config, evaluate)
+    synchronize = synchronize and dist.is_available() and dist.is_initialized()
+
+    if not cache_path.exists() and (not synchronize or dist.get_rank() == 0):
+        processor = FinCausalProcessor()
+        examples = processor.get_examples(file_path)
+
+        features, dataset = fincausal_convert_examples_to_features(
+            examples=examples,
+            tokenizer=tokenizer,
+            max_seq_length=run_config.max_seq_length,
+            doc_stride=run_config.doc_stride,
+            is_training=not evaluate,
+            return_dataset="pt",
+            threads=multiprocessing.cpu_count(),
+        )
+        # Write to a temp file and rename so a killed run can never leave a
+        # truncated cache that later loads would mistake for a valid one
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        torch.save({'tensors': dataset.tensors, 'examples': examples, 'features': features}, tmp_path)
+        os.replace(tmp_path, cache_path)
+        logger.info("Saved preprocessed features to cache %s", cache_path)
+    if synchronize:
+        # Only the main rank tokenizes, the other ranks wait and read the cached copy
+        dist.barrier()
+
+    cached = torch.load(cache_path, map_location="cpu")
+    dataset = TensorDataset(*cached['tensors'])
     if output_examples:
-        return dataset, examples, features
+        return dataset, cached['examples'], cached['features']
     return dataset
 
 
@@ -16,12 +16,15 @@
 # limitations under the License.
 
 import logging
+import re
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, Optional, Union
 
 import torch
+import torch.distributed as dist
 from torch.nn import Module
 from torch.utils.data import RandomSampler, DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import trange, tqdm
 from transformers import PreTrainedTokenizer, PreTrainedTokenizerFast
 
@@ -39,44 +42,63 @@ def train(train_dataset: TensorDataset,
           predict_file: Path,
           log_file: Dict,
           device: torch.device,
-          run_config: RunConfig):
-    train_sampler = RandomSampler(train_dataset)
+          run_config: RunConfig,
+          scaler: Optional[torch.cuda.amp.GradScaler] = None):
+    use_amp = run_config.fp16 and device.type == "cuda"
+    if scaler is None:
+        # Loss scaling is only needed for FP16, BF16 has the same exponent range as FP32
+        scaler = torch.cuda.amp.GradScaler(enabled=use_amp and run_config.amp_dtype is torch.float16)
+    is_distributed = dist.is_available() and dist.is_initialized()
+    is_main_process = not is_distributed or dist.get_rank() == 0
+    if is_distributed:
+        train_sampler = DistributedSampler(train_dataset)
+    else:
+        train_sampler = RandomSampler(train_dataset)
+    # Workers collate and pin the next batches in the background so the
+    # host-to-device copies can run asynchronously
     train_dataloader = DataLoader(train_dataset,
                                   sampler=train_sampler,
-                                  batch_size=run_config.train_batch_size)
+                                  batch_size=run_config.train_batch_size,
+                                  num_workers=2,
+                                  pin_memory=device.type == "cuda",
+                                  persistent_workers=True)
 
     t_total = len(train_dataloader) // run_config.gradient_accumulation_steps * run_config.num_train_epochs
 
-    # Define Optimizer and learning rates / decay
-    no_decay = ["bias", "LayerNorm.weight"]
-    no_scaled_lr = ["cause_outputs", "effect_outputs"]
+    # Define Optimizer and learning rates / decay. The name matching runs as
+    # a single compiled C-level regex scan instead of Python substring tests
+    is_no_decay = re.compile(r"bias|LayerNorm\.weight").search
+    is_no_scaled_lr = re.compile(r"cause_outputs|effect_outputs").search
     if run_config.differential_lr_ratio == 0:
         differential_lr_ratio = 1.0
     else:
         differential_lr_ratio = run_config.differential_lr_ratio
     assert differential_lr_ratio <= 1, "ratio for language model layers should be <= 1"
+    # Classify every parameter in a single named_parameters walk (one decay
+    # and one lr-scaling scan each) instead of four filter passes
+    param_buckets = {(decay, scaled): [] for decay in (False, True) for scaled in (False, True)}
+    for name, parameter in model.named_parameters():
+        decay = is_no_decay(name) is None
+        scaled = is_no_scaled_lr(name) is not None
+        param_buckets[(decay, scaled)].append(parameter)
     optimizer_grouped_parameters = [
         {
-            "params": [p for n, p in model.named_parameters() if (not any(nd in n for nd in no_decay)
-                                                                  and not any(nlr in n for nlr in no_scaled_lr))],
+            "params": param_buckets[(True, False)],
             'lr': run_config.learning_rate * differential_lr_ratio,
             "weight_decay": run_config.weight_decay,
         },
         {
-            "params": [p for n, p in model.named_parameters() if (not any(nd in n for nd in no_decay)
-                                                                  and any(nlr in n for nlr in no_scaled_lr))],
+            "params": param_buckets[(True, True)],
             'lr': run_config.learning_rate,
             "weight_decay": run_config.weight_decay,
         },
         {
-            "params": [p for n, p in model.named_parameters() if (any(nd in n for nd in no_decay)
-                                                                  and not any(nlr in n for nlr in no_scaled_lr))],
+            "params": param_buckets[(False, False)],
             'lr': run_config.learning_rate * differential_lr_ratio,
             "weight_decay": 0.0
         },
         {
-            "params": [p for n, p in model.named_parameters() if (any(nd in n for nd in no_decay)
-                                                                  and any(nlr in n for nlr in no_scaled_lr))],
+            "params": param_buckets[(False, True)],
             'lr': run_config.learning_rate,
             "weight_decay": 0.0
         },
@@ -105,65 +127,81 @@ def train(train_dataset: TensorDataset,
     logger.info("  Gradient Accumulation steps = %d", run_config.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
 
+    # The model input key set only depends on the model type: decide it once
+    # here instead of building and pruning a dict on every step
+    if model_type in ("xlm", "roberta", "distilbert", "camembert"):
+        input_keys = ("input_ids", "attention_mask",
+                      "start_cause_positions", "end_cause_positions",
+                      "start_effect_positions", "end_effect_positions")
+        batch_indices = (0, 1, 3, 4, 5, 6)
+    else:
+        input_keys = ("input_ids", "attention_mask", "token_type_ids",
+                      "start_cause_positions", "end_cause_positions",
+                      "start_effect_positions", "end_effect_positions")
+        batch_indices = (0, 1, 2, 3, 4, 5, 6)
+
     global_step = 1
     epochs_trained = 0
 
-    tr_loss, logging_loss = 0.0, 0.0
-    model.zero_grad()
+    # Running loss lives on the device: adding loss.item() every step would
+    # synchronize the GPU per batch just to feed the progress bar
+    tr_loss = torch.zeros((), device=device)
+    model.zero_grad(set_to_none=True)
     train_iterator = trange(epochs_trained, int(run_config.num_train_epochs), desc="Epoch")
 
-    for _ in train_iterator:
-        epoch_iterator = tqdm(train_dataloader, desc=f"Iteration Loss: {tr_loss / global_step}", position=0, leave=True)
+    for epoch in train_iterator:
+        if is_distributed:
+            train_sampler.set_epoch(epoch)
+        epoch_iterator = tqdm(train_dataloader, desc="Iteration", position=0, leave=True)
         for step, batch in enumerate(epoch_iterator):
-            epoch_iterator.set_description(f"Iteration Loss: {tr_loss / global_step}")
+            # Refreshing the loss readout every step forces a string format
+            # and terminal redraw per batch; every 50 steps is plenty
+            if step % 50 == 0:
+                epoch_iterator.set_description(f"Iteration Loss: {tr_loss.item() / global_step}")
 
             model.train()
-            batch = tuple(t.to(device) for t in batch)
-
-            inputs = {
-                "input_ids": batch[0],
-                "attention_mask": batch[1],
-                "token_type_ids": batch[2],
-                "start_cause_positions": batch[3],
-                "end_cause_positions": batch[4],
-                "start_effect_positions": batch[5],
-                "end_effect_positions": batch[6],
-            }
-
-            if model_type in ["xlm", "roberta", "distilbert", "camembert"]:
-                del inputs["token_type_ids"]
+            inputs = {key: batch[index].to(device, non_blocking=True)
+                      for key, index in zip(input_keys, batch_indices)}
 
-            outputs = model(**inputs)
-            loss = outputs[0]
+            with torch.autocast(device_type="cuda", dtype=run_config.amp_dtype, enabled=use_amp):
+                outputs = model(**inputs)
+                loss = outputs[0]
 
             if run_config.gradient_accumulation_steps > 1:
                 loss = loss / run_config.gradient_accumulation_steps
 
-            loss.backward()
+            scaler.scale(loss).backward()
 
-            tr_loss += loss.item()
+            tr_loss += loss.detach()
             if (step + 1) % run_config.gradient_accumulation_steps == 0:
+                scaler.unscale_(optimizer)
                 torch.nn.utils.clip_grad_norm_(model.parameters(), run_config.max_grad_norm)
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()
-                model.zero_grad()
+                model.zero_grad(set_to_none=True)
                 global_step += 1
 
-        # Evaluate model and log metrics
-        if run_config.evaluate_during_training:
-            metrics = evaluate(model=model,
+        # Evaluate model and log metrics (on the main process only, the other
+        # ranks wait at the barrier so all ranks start the next epoch together)
+        if run_config.evaluate_during_training and is_main_process:
+            model_to_eval = model.module if hasattr(model, "module") else model
+            metrics = evaluate(model=model_to_eval,
                                tokenizer=tokenizer,
                                device=device,
                                file_path=predict_file,
                                model_type=model_type,
                                output_dir=output_dir,
-                               run_config=run_config)
+                               run_config=run_config,
+                               batch_size=run_config.eval_batch_size)
             log_file[f'step_{global_step}'] = metrics
 
             _output_dir = output_dir / "checkpoint-{}".format(global_step)
             if not _output_dir.is_dir():
                 _output_dir.mkdir(parents=True, exist_ok=True)
 
-            model.save_pretrained(_output_dir)
+            model_to_eval.save_pretrained(_output_dir)
             tokenizer.save_pretrained(_output_dir)
             logger.info("Best F1 score: saving model checkpoint to %s", _output_dir)
+        if is_distributed and run_config.evaluate_during_training:
+            dist.barrier()